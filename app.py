@@ -1,9 +1,23 @@
 # app.py
 import os
+import re
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator
+from typing import TYPE_CHECKING
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
+from kernels import tally
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 # ===============================
 # Config
@@ -25,21 +39,24 @@ st.markdown("""
 
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 GROQ_MODEL = "llama-3.1-8b-instant"
+GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+MAX_CONCURRENCY = 8  # parallel Groq requests for bulk uploads
+RESPONSE_TTL = 3600  # seconds a Groq reply stays in the shared response cache
+RESPONSE_MAX_ENTRIES = 500
+DASHBOARD_MAX_ENTRIES = 32  # cached frame pairs shared by all sessions; one per history state
+EMBED_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_THRESHOLD = 0.92  # cosine similarity above which a prior result is reused
+SENTIMENT_ORDER = ["Positive", "Negative", "Neutral"]
+SENTIMENT_CODES = {"Negative": -1, "Neutral": 0, "Positive": 1}  # code + 1 is the tally column
+JSON_BLOCK_RE = re.compile(r"\{.*\}", re.DOTALL)
+SENT_RE = re.compile(r"\b(positive|negative|neutral)\b", re.IGNORECASE)
 
 # ===============================
 # Helper: Call Groq API
 # ===============================
-def analyze_sentiment(feedback: str) -> dict:
-    if not GROQ_API_KEY:
-        return {"error": "Missing GROQ_API_KEY"}
-
-    url = "https://api.groq.com/openai/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "model": GROQ_MODEL,
+def build_payload(feedback: str, model: str = GROQ_MODEL) -> dict:
+    return {
+        "model": model,
         "messages": [
             {"role": "system", "content": "You are a sentiment analysis assistant for liquor market feedback."},
             {"role": "user", "content": f"""
@@ -55,19 +72,271 @@ def analyze_sentiment(feedback: str) -> dict:
         "temperature": 0.0
     }
 
+@st.cache_resource(show_spinner=False)
+def get_http() -> requests.Session:
+    # Shared session keeps TCP/TLS connections to Groq alive between calls
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {GROQ_API_KEY}",
+        "Content-Type": "application/json"
+    })
+    session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+    return session
+
+def analyze_sentiment_stream(feedback: str, model: str = GROQ_MODEL) -> Iterator[str]:
+    # Yield content deltas from Groq's server-sent events as they arrive
+    payload = {**build_payload(feedback, model), "stream": True}
+    with get_http().post(GROQ_URL, data=orjson.dumps(payload), stream=True, timeout=30) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            data = line[len(b"data: "):]
+            if data == b"[DONE]":
+                break
+            delta = orjson.loads(data)["choices"][0]["delta"].get("content")
+            if delta:
+                yield delta
+
+def parse_analysis(content: str) -> dict:
+    # Parse the model reply once at ingestion; it may wrap the JSON in prose.
+    # orjson.JSONDecodeError subclasses ValueError.
+    parsed = None
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=30)
+        parsed = orjson.loads(content)
+    except ValueError:
+        match = JSON_BLOCK_RE.search(content)
+        if match:
+            try:
+                parsed = orjson.loads(match.group(0))
+            except ValueError:
+                pass
+
+    if isinstance(parsed, dict):
+        # Only the sentiment field counts; aspects and insight mention labels too
+        label_source = str(parsed.get("overall_sentiment", ""))
+    else:
+        # No JSON object at all: take the first whole-word label in the reply
+        parsed = {}
+        label_source = content
+    match = SENT_RE.search(label_source)
+    sentiment = match.group(1).title() if match else "Neutral"
+
+    try:
+        score = float(parsed.get("sentiment_score", 0.0))
+    except (TypeError, ValueError):
+        score = 0.0
+
+    return {
+        "sentiment": sentiment,
+        "score": score,
+        "aspects": parsed.get("top_aspects", []),
+        "insight": parsed.get("short_actionable_insight", ""),
+        "code": SENTIMENT_CODES[sentiment],
+        "raw": content
+    }
+
+# ===============================
+# Helper: Concurrent Groq calls (bulk upload)
+# ===============================
+async def analyze_sentiment_async(client: httpx.AsyncClient, feedback: str) -> dict:
+    try:
+        resp = await client.post(GROQ_URL, content=orjson.dumps(build_payload(feedback)))
         resp.raise_for_status()
-        content = resp.json()["choices"][0]["message"]["content"]
-        return {"raw": content}
+        return parse_analysis(orjson.loads(resp.content)["choices"][0]["message"]["content"])
+    except Exception as e:
+        return {"error": str(e)}
+
+async def analyze_many(feedbacks: list[str]) -> list[dict]:
+    if not GROQ_API_KEY:
+        return [{"error": "Missing GROQ_API_KEY"} for _ in feedbacks]
+
+    # Serve repeats from the response and semantic caches; only misses hit Groq
+    results = {}
+    pending = []
+    for feedback in dict.fromkeys(feedbacks):  # unique texts, in order
+        content = cached_response((feedback, GROQ_MODEL))
+        if content is not None:
+            results[feedback] = parse_analysis(content)
+        else:
+            pending.append(feedback)
+
+    try:
+        embeddings = get_embedder().encode(pending, normalize_embeddings=True) if pending else []
+    except Exception:
+        # Model unavailable (e.g. no hub access): skip semantic caching
+        embeddings = [None] * len(pending)
+
+    misses = []
+    for feedback, embedding in zip(pending, embeddings):
+        cached = semantic_lookup(embedding) if embedding is not None else None
+        if cached is not None:
+            results[feedback] = cached
+        else:
+            misses.append((feedback, embedding))
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    headers = {
+        "Authorization": f"Bearer {GROQ_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+    async with httpx.AsyncClient(headers=headers, timeout=30) as client:
+        async def bounded(feedback: str) -> dict:
+            async with semaphore:
+                return await analyze_sentiment_async(client, feedback)
+
+        fetched = await asyncio.gather(*(bounded(fb) for fb, _ in misses))
+
+    for (feedback, embedding), result in zip(misses, fetched):
+        results[feedback] = result
+        if result.get("raw"):
+            store_response((feedback, GROQ_MODEL), result["raw"])
+            if embedding is not None:
+                st.session_state.sem_cache.append((embedding, result))
+
+    return [results[feedback] for feedback in feedbacks]
+
+# ===============================
+# Helper: Response cache
+# ===============================
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> tuple[OrderedDict, threading.Lock]:
+    # Process-wide, so every session shares it; maps (feedback, model) to
+    # (stored_at, content) in least-recently-used order
+    return OrderedDict(), threading.Lock()
+
+def cached_response(key: tuple[str, str]) -> str | None:
+    cache, lock = get_response_cache()
+    with lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        stored_at, content = entry
+        if time.monotonic() - stored_at > RESPONSE_TTL:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return content
+
+def store_response(key: tuple[str, str], content: str):
+    cache, lock = get_response_cache()
+    with lock:
+        cache[key] = (time.monotonic(), content)
+        cache.move_to_end(key)
+        while len(cache) > RESPONSE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+# ===============================
+# Helper: Semantic cache
+# ===============================
+@st.cache_resource(show_spinner="Loading embedding model...")
+def get_embedder() -> "SentenceTransformer":
+    # Imported here so torch only loads on first use, and a missing package is
+    # handled like any other embedder failure in analyze_sentiment
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBED_MODEL)
+
+def semantic_lookup(embedding: np.ndarray) -> dict | None:
+    sem_cache = st.session_state.sem_cache
+    if not sem_cache:
+        return None
+
+    # Embeddings are unit-normalised, so the dot product is the cosine similarity
+    sims = np.stack([emb for emb, _ in sem_cache]) @ embedding
+    best = int(np.argmax(sims))
+    if sims[best] > SEMANTIC_THRESHOLD:
+        return sem_cache[best][1]
+    return None
+
+def analyze_sentiment(feedback: str) -> dict:
+    if not GROQ_API_KEY:
+        return {"error": "Missing GROQ_API_KEY"}
+
+    # Exact repeats from any session skip both the embedding and the call
+    key = (feedback, GROQ_MODEL)
+    content = cached_response(key)
+    if content is not None:
+        return parse_analysis(content)
+
+    try:
+        embedding = get_embedder().encode(feedback, normalize_embeddings=True)
+        cached = semantic_lookup(embedding)
+    except Exception:
+        # Model unavailable (e.g. no hub access): skip semantic caching
+        embedding, cached = None, None
+    if cached is not None:
+        return cached
+
+    try:
+        # Show tokens as they arrive; write_stream returns the full text
+        content = st.write_stream(analyze_sentiment_stream(feedback))
     except Exception as e:
         return {"error": str(e)}
 
+    result = parse_analysis(content)
+    # An empty stream (no deltas) is not an answer worth serving again
+    if content:
+        store_response(key, content)
+        if embedding is not None:
+            st.session_state.sem_cache.append((embedding, result))
+    return result
+
+# ===============================
+# Helper: Dashboard frames
+# ===============================
+@st.cache_data(ttl=RESPONSE_TTL, max_entries=DASHBOARD_MAX_ENTRIES, show_spinner=False)
+def build_dashboard_frames(feedback_data: dict) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # Hashed on the column lists, so the cache only misses when feedback is added
+    data = pd.DataFrame(feedback_data)
+    # Repeated brand/flavor strings become small integer codes
+    data["brand"] = data["brand"].astype("category")
+    data["flavor"] = data["flavor"].astype("category")
+
+    df = pd.DataFrame({
+        "Brand": data["brand"],
+        "Flavor": data["flavor"],
+        "Feedback & Analysis": "Feedback: " + data["feedback"] + "\n\nAnalysis: " + data["analysis"]
+    })
+
+    brand_ids = data["brand"].cat.codes.to_numpy()
+    brand_names = data["brand"].cat.categories
+    sents = data["code"].to_numpy(dtype=np.int8)
+    counts = tally(brand_ids, sents, len(brand_names))
+
+    # Convert counts to percentages on the raw array; every brand has at least one row
+    pct = counts.astype(np.float32)
+    pct *= 100.0 / pct.sum(axis=1, keepdims=True)
+    percent_df = pd.DataFrame(
+        pct,
+        index=pd.Index(brand_names, name="Brand"),
+        columns=list(SENTIMENT_CODES)
+    )[SENTIMENT_ORDER]
+
+    return df, percent_df
+
 # ===============================
 # Data store (in session)
 # ===============================
+# Columnar (one list per field) so the dashboard builds its DataFrame directly
 if "feedback_data" not in st.session_state:
-    st.session_state.feedback_data = []
+    st.session_state.feedback_data = {
+        "brand": [], "flavor": [], "feedback": [], "analysis": [],
+        "sentiment": [], "score": [], "code": []
+    }
+if "sem_cache" not in st.session_state:
+    st.session_state.sem_cache = []  # (embedding, result) pairs
+
+def add_feedback(brand: str, flavor: str, feedback: str, result: dict):
+    data = st.session_state.feedback_data
+    data["brand"].append(brand)
+    data["flavor"].append(flavor)
+    data["feedback"].append(feedback)
+    data["analysis"].append(str(result.get("raw", str(result))))
+    # Failed calls carry no parsed fields and count as Neutral
+    data["sentiment"].append(result.get("sentiment", "Neutral"))
+    data["score"].append(result.get("score", float("nan")))
+    data["code"].append(result.get("code", 0))
 
 # ===============================
 # Tabs
@@ -77,48 +346,78 @@ tab1, tab2 = st.tabs(["📝 Feedback Input", "📊 Sentiment Dashboard"])
 # -------------------------------
 # TAB 1: Input
 # -------------------------------
-with tab1:
+# Fragments rerun on their own widget interactions, so typing here does not
+# rebuild the dashboard; a submission triggers one full rerun to refresh it.
+@st.fragment
+def render_input():
     st.header("Enter Liquor Brand Feedback")
 
-    col1, col2 = st.columns(2)
-    with col1:
-        brand = st.text_input("Brand Name", placeholder="e.g., Jack Daniels")
-    with col2:
-        flavor = st.text_input("Flavor / Variant", placeholder="e.g., Honey, Classic")
+    if "flash" in st.session_state:
+        st.success(st.session_state.pop("flash"))
+        if "last_analysis" in st.session_state:
+            st.markdown(st.session_state.pop("last_analysis"))
+
+    # Inputs only rerun the script once the form is submitted
+    with st.form("feedback_form"):
+        col1, col2 = st.columns(2)
+        with col1:
+            brand = st.text_input("Brand Name", placeholder="e.g., Jack Daniels")
+        with col2:
+            flavor = st.text_input("Flavor / Variant", placeholder="e.g., Honey, Classic")
 
-    feedback_text = st.text_area("Customer Feedback", placeholder="Enter feedback here...", height=120)
+        feedback_text = st.text_area("Customer Feedback", placeholder="Enter feedback here...", height=120)
 
-    if st.button("🔍 Analyze Sentiment"):
+        submitted = st.form_submit_button("🔍 Analyze Sentiment")
+
+    if submitted:
         if brand and feedback_text:
             result = analyze_sentiment(feedback_text)
-            st.session_state.feedback_data.append({
-                "brand": brand,
-                "flavor": flavor,
-                "feedback": feedback_text,
-                "result": result
-            })
-            st.success("Feedback submitted and analyzed!")
+            add_feedback(brand, flavor, feedback_text, result)
+            st.session_state.flash = "Feedback submitted and analyzed!"
+            if "raw" in result:
+                st.session_state.last_analysis = result["raw"]
+            st.rerun()
         else:
             st.warning("Please enter both Brand and Feedback.")
 
+    st.subheader("📂 Bulk Upload")
+    uploaded = st.file_uploader("CSV with columns: brand, flavor, feedback", type="csv")
+
+    if uploaded is not None and st.button("📥 Analyze CSV"):
+        try:
+            rows = pd.read_csv(uploaded, dtype=str).fillna("")
+        except (pd.errors.EmptyDataError, pd.errors.ParserError, UnicodeDecodeError):
+            rows = None
+
+        if rows is None:
+            st.warning("Could not read the CSV; check that it is a non-empty, well-formed file.")
+        elif not {"brand", "feedback"}.issubset(rows.columns):
+            st.warning("CSV must contain 'brand' and 'feedback' columns.")
+        else:
+            if "flavor" not in rows.columns:
+                rows["flavor"] = ""
+            rows = rows[(rows["brand"] != "") & (rows["feedback"] != "")]
+
+            results = asyncio.run(analyze_many(rows["feedback"].tolist()))
+            for row, result in zip(rows.itertuples(index=False), results):
+                add_feedback(row.brand, row.flavor, row.feedback, result)
+            st.session_state.flash = f"{len(results)} feedback rows submitted and analyzed!"
+            st.rerun()
+
+with tab1:
+    render_input()
+
 # -------------------------------
 # TAB 2: Dashboard
 # -------------------------------
-with tab2:
+@st.fragment
+def render_dashboard():
     st.header("📊 Brand Sentiment Dashboard")
 
-    if not st.session_state.feedback_data:
+    if not st.session_state.feedback_data["brand"]:
         st.info("No feedback yet. Add some in the first tab.")
     else:
-        # Keep table
-        df = pd.DataFrame([
-            {
-                "Brand": item["brand"],
-                "Flavor": item["flavor"],
-                "Feedback & Analysis": f"Feedback: {item['feedback']}\n\nAnalysis: {item['result'].get('raw', str(item['result']))}"
-            }
-            for item in st.session_state.feedback_data
-        ])
+        df, percent_df = build_dashboard_frames(st.session_state.feedback_data)
 
         st.subheader("📋 Recent Feedback & Analysis")
         st.dataframe(df, use_container_width=True, height=250)
@@ -126,73 +425,18 @@ with tab2:
         # Compact sentiment chart
         st.subheader("📈 Brand Sentiment Trend")
 
-        sentiment_summary = []
-        for item in st.session_state.feedback_data:
-            analysis = str(item["result"].get("raw", "")).lower()
-            if "positive" in analysis:
-                sentiment_summary.append((item["brand"], "Positive"))
-            elif "negative" in analysis:
-                sentiment_summary.append((item["brand"], "Negative"))
-            else:
-                sentiment_summary.append((item["brand"], "Neutral"))
-
-        trend_df = pd.DataFrame(sentiment_summary, columns=["Brand", "Sentiment"])
-        counts = trend_df.groupby(["Brand", "Sentiment"]).size().unstack(fill_value=0)
-
                     # Place chart in a medium column
         col_chart, _ = st.columns([2, 1])  # chart takes medium space
         with col_chart:
-            fig, ax = plt.subplots(figsize=(4.5, 3), dpi=120)  # medium box
-
-            # Fixed color mapping
-            colors = {"Positive": "green", "Negative": "red", "Neutral": "gray"}
-            ordered_cols = ["Positive", "Negative", "Neutral"]
-
-            # Convert counts to percentages
-            percent_df = counts.div(counts.sum(axis=1), axis=0) * 100
-
-            # Reindex to enforce consistent order
-            percent_df = percent_df.reindex(columns=ordered_cols, fill_value=0)
-
-            # Explicitly map colors column by column
-            for i, col in enumerate(percent_df.columns):
-                ax.bar(
-                    percent_df.index,
-                    percent_df[col],
-                    bottom=percent_df.iloc[:, :i].sum(axis=1),
-                    label=col,
-                    color=colors[col],
-                    width=0.35
-                )
-
-            # Add percentage labels outside the bars
-            for container in ax.containers:
-                for bar in container:
-                    value = bar.get_height()
-                    if value > 0:
-                        ax.text(
-                            bar.get_x() + bar.get_width() / 2,
-                            bar.get_y() + bar.get_height() + 1,
-                            f"{value:.0f}%",
-                            ha="center",
-                            va="bottom",
-                            fontsize=8,
-                            color="black"
-                        )
-
-            ax.set_ylabel("Share (%)", fontsize=8)
-            ax.set_title("Sentiment by Brand", fontsize=9)
-            plt.xticks(rotation=30, ha="right", fontsize=7)
-
-            # Add legend on right side
-            handles = [plt.Rectangle((0, 0), 1, 1, color=colors[c]) for c in ordered_cols]
-            ax.legend(
-                handles, ordered_cols,
-                loc="center left",
-                bbox_to_anchor=(1.02, 0.5),  # outside right
-                fontsize=8,
-                frameon=False
+            # Vega-Lite renders client-side; colors follow SENTIMENT_ORDER
+            st.bar_chart(
+                percent_df,
+                x_label="Brand",
+                y_label="Share (%)",
+                color=["#00aa00", "#cc0000", "#888888"],
+                stack="normalize",
+                height=300
             )
 
-            plt.tight_layout()
-            st.pyplot(fig, clear_figure=True)
+with tab2:
+    render_dashboard()
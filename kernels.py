@@ -0,0 +1,13 @@
+# kernels.py
+# Numba kernels live outside app.py: Streamlit re-executes the script on every
+# rerun, but this module is imported once, so compiled dispatchers persist.
+import numpy as np
+from numba import njit
+
+@njit(cache=True)
+def tally(brand_ids: np.ndarray, sents: np.ndarray, n_brands: int) -> np.ndarray:
+    # Per-brand counts of Negative / Neutral / Positive feedback
+    out = np.zeros((n_brands, 3), np.int64)
+    for i in range(sents.size):
+        out[brand_ids[i], sents[i] + 1] += 1
+    return out